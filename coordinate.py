@@ -0,0 +1,255 @@
+import time, logging, sqlite3, threading
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from uuid import uuid5, UUID
+import boto3
+from boto3.dynamodb.conditions import Key, Attr
+
+# coordinate.py lets several receiver stations share one pass schedule so that each pass is recorded and
+# published once. Every station announces the passes it predicts, with its predicted max elevation, to a
+# shared backend. At AOS the best placed station claims the pass; the others wait failoverDelay seconds per
+# rank and only take over (recording the remainder of the pass) if nobody has claimed it yet. The upcoming pass
+# preview is sent by a single station, the first to claim it.
+#
+# Backends:
+# - SQLiteBackend: a local sqlite file, for testing several stations on one machine or a shared filesystem
+# - DynamoDBBackend: a DynamoDB table with partition key 'passId' (S) and sort key 'station' (S), for production
+
+# namespace for deterministic pass IDs, shared by all stations
+PASS_NAMESPACE = UUID('6f1c2b8e-3d4a-5e7f-9a0b-1c2d3e4f5a6b')
+
+# sort key used for the claim record of a pass, alongside the per-station candidate records
+CLAIM_KEY = '#claim'
+
+# suffix of the pass ID claimed by the station that sends the pass preview
+PREVIEW_SUFFIX = ':preview'
+
+# candidates and claims are kept for a day, long enough to cover any pass being coordinated
+RETENTION = timedelta(days=1)
+
+# announcements of the same satellite with AOS this close together are the same pass: well above the spread of AOS
+# between sites that see the same pass, and well below the ~100 minute orbital period of the NOAA satellites
+PASS_MATCH_WINDOW = timedelta(minutes=30)
+
+
+# deterministic ID for a satellite pass, from the orbit number at max elevation. Stations on the same side of the
+# ascending node crossing get the same ID without talking to each other, but stations whose peaks fall either side
+# of the crossing do not; Coordinator.reconcile settles those through the backend (see PASS_MATCH_WINDOW)
+def passID(satellite):
+    return str(uuid5(PASS_NAMESPACE, '{}:{}'.format(satellite.identifier, satellite.nextPass.orbit)))
+
+
+# shared pass schedule backed by a sqlite file
+class SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS candidates (passId TEXT, satellite TEXT, station TEXT, elevation REAL, aos REAL, announced REAL, updated REAL, PRIMARY KEY (passId, station))')
+            db.execute('CREATE TABLE IF NOT EXISTS claims (passId TEXT PRIMARY KEY, station TEXT, claimed REAL)')
+
+    # serialise access within this process, commit on success and always close the connection;
+    # sqlite's own file locking serialises stations running as separate processes
+    @contextmanager
+    def connect(self):
+        with self.lock:
+            db = sqlite3.connect(self.path, timeout=30)
+            try:
+                with db:
+                    yield db
+            finally:
+                db.close()
+
+    # register or refresh this station as a candidate for a pass, keeping the time it was first announced,
+    # and drop expired records
+    def publish(self, passId, satellite, station, elevation, aos):
+        now = time.time()
+        expired = now - RETENTION.total_seconds()
+        with self.connect() as db:
+            db.execute('INSERT INTO candidates VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (passId, station) DO UPDATE SET elevation = excluded.elevation, aos = excluded.aos, updated = excluded.updated',
+                (passId, satellite, station, elevation, aos, now, now))
+            db.execute('DELETE FROM candidates WHERE updated < ?', (expired,))
+            db.execute('DELETE FROM claims WHERE claimed < ?', (expired,))
+
+    # list of (station, elevation, aos) for every station that announced the pass
+    def candidates(self, passId):
+        with self.connect() as db:
+            return db.execute('SELECT station, elevation, aos FROM candidates WHERE passId = ?', (passId,)).fetchall()
+
+    # remove this station's candidate record for a pass
+    def withdraw(self, passId, station):
+        with self.connect() as db:
+            db.execute('DELETE FROM candidates WHERE passId = ? AND station = ?', (passId, station))
+
+    # list of (passId, announced) for each pass ID announced for the satellite with AOS within window seconds of aos,
+    # with the earliest time any station announced it
+    def passesNear(self, satellite, aos, window):
+        with self.connect() as db:
+            return db.execute('SELECT passId, MIN(announced) FROM candidates WHERE satellite = ? AND aos BETWEEN ? AND ? GROUP BY passId',
+                (satellite, aos - window, aos + window)).fetchall()
+
+    # atomically claim a pass, returns the station holding the claim (which may be another station)
+    def claim(self, passId, station):
+        with self.connect() as db:
+            db.execute('INSERT OR IGNORE INTO claims VALUES (?, ?, ?)', (passId, station, time.time()))
+            return db.execute('SELECT station FROM claims WHERE passId = ?', (passId,)).fetchone()[0]
+
+    # station holding the claim on a pass, or None
+    def claimedBy(self, passId):
+        with self.connect() as db:
+            row = db.execute('SELECT station FROM claims WHERE passId = ?', (passId,)).fetchone()
+            return row[0] if row else None
+
+
+# shared pass schedule backed by a DynamoDB table, expiring records through the table's 'expires' TTL attribute
+class DynamoDBBackend:
+    def __init__(self, table, region):
+        self.table = boto3.resource('dynamodb', region_name=region).Table(table)
+
+    def expires(self):
+        return int(time.time() + RETENTION.total_seconds())
+
+    def publish(self, passId, satellite, station, elevation, aos):
+        self.table.update_item(
+            Key={'passId': passId, 'station': station},
+            UpdateExpression='SET satellite = :satellite, elevation = :elevation, aos = :aos, expires = :expires, announced = if_not_exists(announced, :now)',
+            ExpressionAttributeValues={
+                ':satellite': satellite,
+                ':elevation': Decimal(str(elevation)),
+                ':aos': Decimal(str(aos)),
+                ':expires': self.expires(),
+                ':now': Decimal(str(time.time()))
+            })
+
+    def withdraw(self, passId, station):
+        self.table.delete_item(Key={'passId': passId, 'station': station})
+
+    # the table only holds a day of passes (TTL), so a filtered scan is cheap enough here
+    def passesNear(self, satellite, aos, window):
+        response = self.table.scan(
+            FilterExpression=Attr('satellite').eq(satellite) & Attr('aos').between(Decimal(str(aos - window)), Decimal(str(aos + window))),
+            ConsistentRead=True)
+        announced = {}
+        for item in response['Items']:
+            announced[item['passId']] = min(float(item['announced']), announced.get(item['passId'], float('inf')))
+        return list(announced.items())
+
+    def candidates(self, passId):
+        response = self.table.query(KeyConditionExpression=Key('passId').eq(passId), ConsistentRead=True)
+        return [(item['station'], float(item['elevation']), float(item['aos'])) for item in response['Items'] if item['station'] != CLAIM_KEY]
+
+    def claim(self, passId, station):
+        try:
+            self.table.put_item(
+                Item={'passId': passId, 'station': CLAIM_KEY, 'claimedBy': station, 'expires': self.expires()},
+                ConditionExpression='attribute_not_exists(passId)'
+            )
+            return station
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return self.claimedBy(passId)
+
+    def claimedBy(self, passId):
+        response = self.table.get_item(Key={'passId': passId, 'station': CLAIM_KEY}, ConsistentRead=True)
+        return response.get('Item', {}).get('claimedBy')
+
+
+# decides which station records each pass, given a shared backend
+class Coordinator:
+    def __init__(self, backend, station, failoverDelay, minChunkDuration=0):
+        self.backend = backend
+        self.station = station
+        self.failoverDelay = failoverDelay
+        self.minChunkDuration = minChunkDuration
+
+    # share this station's prediction for the satellite's next pass, then settle its ID with other stations
+    def announce(self, satellite):
+        self.backend.publish(satellite.nextPass.performanceID, satellite.identifier, self.station, satellite.nextPass.elevation, satellite.nextPass.passTime.timestamp())
+        self.reconcile(satellite)
+
+    # stations whose peaks fall either side of the ascending node announce the same pass under different IDs. Of the
+    # IDs announced for the satellite within PASS_MATCH_WINDOW of this station's AOS, every station adopts the one
+    # announced first (ties broken by the smallest ID), moving its candidate record over to it. Stations that
+    # announce at the same time each publish before searching, so whichever searches last sees both IDs and the
+    # other converges when it reconciles again at AOS; an ID that has been announced is never replaced by a later one
+    def reconcile(self, satellite):
+        satPass = satellite.nextPass
+        aos = satPass.passTime.timestamp()
+        passes = self.backend.passesNear(satellite.identifier, aos, PASS_MATCH_WINDOW.total_seconds())
+        if not passes:
+            return
+        chosen = min(passes, key=lambda p: (p[1], p[0]))[0]
+        if chosen != satPass.performanceID:
+            logging.info('Adopting pass ID {} announced by another station for {} (was {})'.format(chosen, satellite.identifier, satPass.performanceID))
+            self.backend.withdraw(satPass.performanceID, self.station)
+            satPass.performanceID = chosen
+            self.backend.publish(chosen, satellite.identifier, self.station, satPass.elevation, aos)
+
+    # candidates for the pass, highest elevation first with ties broken by name
+    def ranking(self, satellite):
+        return sorted(self.backend.candidates(satellite.nextPass.performanceID), key=lambda c: (-c[1], c[0]))
+
+    # called after announce: the pass start time to put in the preview if this station is the one to send it, or
+    # None if another station has. The start is the AOS of the best placed station known so far, which is when the
+    # recording starts if that station takes the pass, so it does not depend on which station sends the preview
+    def previewStart(self, satellite):
+        passId = satellite.nextPass.performanceID
+        holder = self.backend.claim(passId + PREVIEW_SUFFIX, self.station)
+        if holder != self.station:
+            logging.info('Preview for pass {} sent by {}'.format(passId, holder))
+            return None
+        ranking = self.ranking(satellite)
+        return ranking[0][2] if ranking else satellite.nextPass.passTime.timestamp()
+
+    # called at this station's AOS: wait for this station's turn and claim the pass if no better placed station has.
+    # AOS differs between sites, so turns are counted from the later of this station's AOS and the best placed
+    # station's AOS; a station that sees the pass first does not claim it before the best station is able to.
+    # returns True if this station should record; if its turn comes after its own AOS, the pass start and duration
+    # are moved forward by the difference. A station whose turn leaves less than minChunkDuration of the pass stands
+    # down without claiming it
+    def takePass(self, satellite):
+        self.reconcile(satellite)
+        passId = satellite.nextPass.performanceID
+        ranking = self.ranking(satellite)
+        stations = [station for station, _, _ in ranking]
+        rank = stations.index(self.station) if self.station in stations else len(stations)
+
+        aos = satellite.nextPass.passTime.timestamp()
+        bestAOS = ranking[0][2] if ranking else aos
+        turn = max(aos, bestAOS) + rank * self.failoverDelay
+        delay = turn - aos
+        if satellite.nextPass.duration - max(delay, 0) < self.minChunkDuration:
+            logging.info('Station {} is ranked {} for pass {}, too late to record a chunk'.format(self.station, rank, passId))
+            return False
+
+        wait = turn - time.time()
+        if wait > 0:
+            logging.info('Station {} is ranked {} for pass {}, standing by for {}s'.format(self.station, rank, passId, round(wait)))
+            time.sleep(wait)
+
+        holder = self.backend.claim(passId, self.station)
+        if holder != self.station:
+            logging.info('Pass {} already claimed by {}'.format(passId, holder))
+            return False
+
+        if delay > 0:
+            logging.warning('Taking over pass {} {}s after AOS'.format(passId, round(delay)))
+            satellite.nextPass.passTime = satellite.nextPass.passTime + timedelta(seconds=delay)
+            satellite.nextPass.duration = satellite.nextPass.duration - delay
+        logging.info('Station {} claimed pass {}'.format(self.station, passId))
+        return True
+
+
+# build a Coordinator from the COORDINATION section of a groundstation config, or None if disabled
+def fromConfig(config):
+    if not config.has_section('COORDINATION') or not config.getboolean('COORDINATION', 'enabled'):
+        return None
+    backend = config.get('COORDINATION', 'backend')
+    if backend == 'sqlite':
+        store = SQLiteBackend(config.get('COORDINATION', 'sqlitePath'))
+    elif backend == 'dynamodb':
+        store = DynamoDBBackend(config.get('COORDINATION', 'dynamodbTable'), config.get('COORDINATION', 'dynamodbRegion'))
+    else:
+        raise ValueError('Unknown coordination backend {}, expected sqlite or dynamodb'.format(backend))
+    return Coordinator(store, config.get('COORDINATION', 'station'), int(config.get('COORDINATION', 'failoverDelay')),
+        int(config.get('SDR', 'minChunkDuration')))
@@ -0,0 +1,249 @@
+import logging, threading
+from functools import lru_cache
+import numpy as np
+from PIL import Image
+
+# enhance.py turns one uncalibrated APT frame (as written by noaa-apt with '-c disable') into any number of
+# enhanced images. The frame is decoded by noaa-apt once; every variant is then a lookup into a precomputed
+# 256-entry (single channel) or 65536-entry (channel A/B pair) table, so adding a variant costs one indexing
+# pass over the frame rather than another run of noaa-apt over the wav.
+#
+# example usage:
+# engine = EnhancementEngine(['histogram', 'falsecolor', 'thermal', 'mcir'])
+# engine.write('signalchunk_0_raw.png', {'histogram': 'signalchunk_0.png', 'thermal': 'signalchunk_0_thermal.png'})
+
+# APT line layout in pixels (2080 words per line, two lines per second)
+# sync A (39), space A (47), image A (909), telemetry A (45), sync B (39), space B (47), image B (909), telemetry B (45)
+LINE_WIDTH = 2080
+CHANNEL_WIDTH = 1040
+IMAGE_A = (86, 995)
+TELEMETRY_A = (995, 1040)
+IMAGE_B = (1126, 2035)
+TELEMETRY_B = (2035, 2080)
+
+# telemetry frame: 16 wedges, each 8 lines tall, repeating every 128 lines
+# wedges 1-8 step from 1/8 to 8/8 of full scale, wedge 9 is zero modulation
+WEDGE_HEIGHT = 8
+FRAME_HEIGHT = 128
+WEDGE_TARGETS = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8]) * 255 / 8
+
+# a chunk rarely holds a whole telemetry frame, so wedges are located modulo FRAME_HEIGHT and only wedges 1-9
+# are needed; each must cover at least MIN_WEDGE_LINES lines, and wedge 8 must sit MIN_WEDGE_CONTRAST levels
+# above wedge 9 before the wedges are trusted
+MIN_WEDGE_LINES = 4
+MIN_WEDGE_CONTRAST = 64
+
+
+# map a 0..1 position onto a colour ramp given as (position, (r, g, b)) stops
+def colourRamp(position, stops):
+    points = [p for p, _ in stops]
+    rgb = [np.interp(position, points, [c[i] for _, c in stops]) for i in range(3)]
+    return np.stack(rgb, axis=-1)
+
+# linear ramp from 0 to 1 between lo and hi
+def smoothStep(x, lo, hi):
+    return np.clip((x - lo) / (hi - lo), 0, 1)
+
+# channel A and B values (0..1) for every entry of a 65536-entry pair LUT, indexed as (a << 8) | b
+def pairGrid():
+    levels = np.arange(256) / 255
+    a, b = np.meshgrid(levels, levels, indexing='ij')
+    return a.reshape(-1), b.reshape(-1)
+
+def frozen(lut):
+    lut = np.clip(np.rint(lut), 0, 255).astype(np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+
+# calibration LUT from observed wedge levels (wedge 9, then wedges 1-8) to the nominal full scale
+# observed levels are integers so that passes with similar signal levels share the same cached table
+@lru_cache(maxsize=64)
+def calibrationLUT(observed):
+    return frozen(np.interp(np.arange(256), observed, WEDGE_TARGETS))
+
+# thermal palette over the IR channel: APT shows cold as bright, so warm ground is red and cold cloud tops are blue/white
+@lru_cache(maxsize=None)
+def thermalLUT():
+    return frozen(colourRamp(np.arange(256) / 255, [
+        (0.00, (40, 0, 0)),
+        (0.25, (200, 40, 0)),
+        (0.45, (255, 200, 0)),
+        (0.65, (0, 200, 120)),
+        (0.85, (0, 60, 220)),
+        (1.00, (255, 255, 255))]))
+
+# false colour from the visible (A) and IR (B) pair: dark water is blue, bright warm ground is green/brown,
+# and pixels that are both bright and cold blend into white cloud
+@lru_cache(maxsize=None)
+def falseColourLUT():
+    a, b = pairGrid()
+    sea = np.stack([0.05 + 0.2*a, 0.15 + 0.6*a, 0.35 + 0.9*a], axis=-1)
+    land = np.stack([0.30 + 0.6*a, 0.40 + 0.5*a, 0.15 + 0.3*a], axis=-1)
+    landMask = smoothStep(a, 0.12, 0.22)[:, None]
+    ground = sea*(1 - landMask) + land*landMask
+    cloud = (smoothStep(b, 0.45, 0.8) * smoothStep(a, 0.2, 0.5))[:, None]
+    white = np.stack([a, a, a], axis=-1)*0.3 + 0.7
+    return frozen(255 * (ground*(1 - cloud) + white*cloud))
+
+# MCIR-style composite: there is no map underlay on the receiver, so land and sea are coloured from the visible
+# channel and clouds are laid over them using the IR channel alone (which keeps working on the night side)
+@lru_cache(maxsize=None)
+def mcirLUT():
+    a, b = pairGrid()
+    sea = np.array([0.05, 0.20, 0.45])
+    land = np.array([0.25, 0.45, 0.15])
+    landMask = smoothStep(a, 0.12, 0.22)[:, None]
+    ground = sea*(1 - landMask) + land*landMask
+    cloud = smoothStep(b, 0.5, 0.85)[:, None]
+    grey = np.stack([b, b, b], axis=-1)
+    return frozen(255 * (ground*(1 - cloud) + grey*cloud))
+
+# histogram equalisation depends on the chunk being enhanced, so its 256-entry table is built per frame
+def histogramLUT(frame):
+    hist = np.bincount(frame.reshape(-1), minlength=256)
+    cdf = np.cumsum(hist)
+    nonzero = cdf[cdf > 0]
+    if nonzero.size == 0 or cdf[-1] == nonzero[0]:
+        return np.arange(256, dtype=np.uint8)
+    return frozen(255 * (cdf - nonzero[0]) / (cdf[-1] - nonzero[0]))
+
+
+# load a noaa-apt frame as an 8 bit greyscale array, LINE_WIDTH pixels wide
+def loadFrame(path):
+    frame = np.asarray(Image.open(path).convert('L'))
+    if frame.shape[1] != LINE_WIDTH:
+        raise ValueError('{} is {} pixels wide, expected a full {} pixel APT frame'.format(path, frame.shape[1], LINE_WIDTH))
+    return frame
+
+# wedge number (0-15) of every line when a telemetry frame starts at the given phase, and how many lines each covers
+def wedgeIndex(lines, phase):
+    wedges = (np.arange(lines) - phase) % FRAME_HEIGHT // WEDGE_HEIGHT
+    return wedges, np.bincount(wedges, minlength=16)
+
+# observed levels of wedge 9 then wedges 1-8, averaged over every line each covers in the strip
+def wedgeLevels(strip, phase):
+    wedges, counts = wedgeIndex(strip.size, phase)
+    levels = np.bincount(wedges, weights=strip, minlength=16) / np.maximum(counts, 1)
+    return np.concatenate(([levels[8]], levels[:8]))
+
+# wedges 1-9 must be strictly increasing (wedge 9 first) with enough contrast to be used for calibration
+def usableWedges(observed):
+    return np.all(np.diff(observed) > 0) and observed[-1] - observed[0] >= MIN_WEDGE_CONTRAST
+
+# find the phase (line offset modulo FRAME_HEIGHT) of the telemetry frame, or None if wedges 1-9 are not in the strip.
+# of the phases whose wedges 1-9 form a usable ramp, the one with the flattest wedges is taken, since a phase a few
+# lines off blends neighbouring wedges together
+def findTelemetryPhase(strip):
+    best, bestSpread = None, None
+    for phase in range(FRAME_HEIGHT):
+        wedges, counts = wedgeIndex(strip.size, phase)
+        if np.any(counts[:9] < MIN_WEDGE_LINES):
+            continue
+        if not usableWedges(wedgeLevels(strip, phase)):
+            continue
+        inRamp = wedges < 9
+        spread = np.abs(strip[inRamp] - np.bincount(wedges, weights=strip, minlength=16)[wedges[inRamp]] / counts[wedges[inRamp]]).mean()
+        if bestSpread is None or spread < bestSpread:
+            best, bestSpread = phase, spread
+    return best
+
+# per-channel calibration LUTs from the telemetry wedges, None for a channel whose wedges could not be used
+def calibrate(frame):
+    # telemetry strips are averaged across their width, trimming the edges that bleed into sync and image
+    stripA = frame[:, TELEMETRY_A[0]+5:TELEMETRY_A[1]-5].mean(axis=1)
+    stripB = frame[:, TELEMETRY_B[0]+5:TELEMETRY_B[1]-5].mean(axis=1)
+
+    # wedges 1-9 are common to both channels, so the phase is found on their average
+    phase = findTelemetryPhase((stripA + stripB) / 2)
+    if phase is None:
+        return None, None
+
+    luts = []
+    for strip in (stripA, stripB):
+        observed = np.rint(wedgeLevels(strip, phase)).astype(int)
+        luts.append(calibrationLUT(tuple(observed)) if usableWedges(observed) else None)
+    return luts[0], luts[1]
+
+
+# greyscale variant over the whole frame, so the sync and telemetry bars are kept like noaa-apt's own output
+def enhanceHistogram(frame, a, b, pair):
+    return histogramLUT(frame)[frame]
+
+def enhanceThermal(frame, a, b, pair):
+    return thermalLUT()[b]
+
+def enhanceFalseColour(frame, a, b, pair):
+    return falseColourLUT()[pair]
+
+def enhanceMCIR(frame, a, b, pair):
+    return mcirLUT()[pair]
+
+ENHANCEMENTS = {
+    'histogram': enhanceHistogram,
+    'falsecolor': enhanceFalseColour,
+    'thermal': enhanceThermal,
+    'mcir': enhanceMCIR,
+}
+
+
+# produces a configured set of enhanced images from one decoded APT frame
+# one engine is used per pass, so chunks without usable telemetry wedges reuse the calibration of the latest chunk
+# of the pass that had them. Chunks are enhanced in concurrent threads, so the stored calibration is only replaced
+# by a chunk later in the pass than the one it came from; a chunk that finishes early may still get the calibration
+# of a later chunk if that one was enhanced first
+class EnhancementEngine:
+    def __init__(self, variants):
+        if not variants:
+            raise ValueError('No enhancements given, expected at least one of {}'.format(list(ENHANCEMENTS)))
+        unknown = [v for v in variants if v not in ENHANCEMENTS]
+        if unknown:
+            raise ValueError('Unknown enhancement(s) {}, expected one of {}'.format(unknown, list(ENHANCEMENTS)))
+        self.variants = list(variants)
+        # per channel (chunk order, LUT) of the latest calibrated chunk
+        self.calibration = [(None, None), (None, None)]
+        self.lock = threading.Lock()
+
+    # per-channel calibration LUTs for the frame, falling back to the pass's stored calibration, then the identity.
+    # order is the chunk's position in the pass; frames without one (e.g. the archive) do not update the stored calibration
+    def calibrate(self, raw, order=None):
+        luts = []
+        for index, lut in enumerate(calibrate(raw)):
+            channel = 'AB'[index]
+            with self.lock:
+                storedOrder, storedLUT = self.calibration[index]
+                if lut is not None:
+                    if order is not None and (storedOrder is None or order > storedOrder):
+                        self.calibration[index] = (order, lut)
+                elif storedLUT is not None:
+                    logging.info('No usable telemetry wedges in channel {}, using the calibration of chunk {}'.format(channel, storedOrder))
+                    lut = storedLUT
+                else:
+                    logging.warning('No usable telemetry wedges in channel {}, enhancing it uncalibrated'.format(channel))
+                    lut = np.arange(256, dtype=np.uint8)
+            luts.append(lut)
+        return luts
+
+    # calibrate the frame once and return a dict of variant name -> image array
+    def process(self, framePath, order=None):
+        raw = loadFrame(framePath)
+        lutA, lutB = self.calibrate(raw, order)
+
+        # calibrated full frame, then the two image channels and their combined 16 bit pair index,
+        # which are shared by every variant
+        frame = np.empty_like(raw)
+        frame[:, :CHANNEL_WIDTH] = lutA[raw[:, :CHANNEL_WIDTH]]
+        frame[:, CHANNEL_WIDTH:] = lutB[raw[:, CHANNEL_WIDTH:]]
+        a = frame[:, IMAGE_A[0]:IMAGE_A[1]]
+        b = frame[:, IMAGE_B[0]:IMAGE_B[1]]
+        pair = (a.astype(np.uint16) << 8) | b
+
+        return {v: ENHANCEMENTS[v](frame, a, b, pair) for v in self.variants}
+
+    # enhance the frame and save each variant to the path given for it in outPaths
+    def write(self, framePath, outPaths, order=None):
+        images = self.process(framePath, order)
+        for variant, path in outPaths.items():
+            Image.fromarray(images[variant]).save(path)
+            logging.info('Wrote {} enhancement to {}'.format(variant, path))
+        return images
@@ -1,8 +1,8 @@
 import os, sys, subprocess, threading, time, math
 import operator, json, logging
 from datetime import datetime, timezone, timedelta
-from uuid import uuid4
 import sox, predict, boto3, cfg, requests
+import enhance, coordinate, shaper
 
 
 # overrides predict and forces the next satellite pass 2 seconds from script execution
@@ -42,27 +42,30 @@ class WeatherSatellite:
         while((transit.peak()['elevation'] < minElev) or transit.start-datetime.timestamp(current_time)<0 ):
             transit = next(p)
         dt_ts = datetime.fromtimestamp(transit.start + cut_start, tz=timezone.utc)
-        self.nextPass = SatPass(dt_ts,  transit.duration()-(cut_start + cut_end), transit.peak()['elevation'])
+        self.nextPass = SatPass(dt_ts,  transit.duration()-(cut_start + cut_end), transit.peak()['elevation'], transit.peak()['orbit'])
         if testMode_recording:
             # transit.duration()
-            self.nextPass = SatPass(datetime.now(timezone.utc) + timedelta(seconds=2), 120, transit.peak()['elevation'])
+            self.nextPass = SatPass(datetime.now(timezone.utc) + timedelta(seconds=2), 120, transit.peak()['elevation'], transit.peak()['orbit'])
         return self.nextPass
 
 class SatPass:
-    def __init__(self, passTime, passDuration, passElevation):
+    def __init__(self, passTime, passDuration, passElevation, orbit=None):
         self.passTime = passTime
         self.duration = passDuration
         self.elevation = passElevation
+        self.orbit = orbit
         self.lastUpdated = datetime.now(timezone.utc)
         self.performanceId = None
 
 class AWS:
-    def __init__(self, s3_region, sqs_region):
+    def __init__(self, s3_region, sqs_region, uploadShaper=None):
         self.s3 = boto3.resource('s3', region_name=s3_region)
         self.s3_archive = boto3.resource('s3', region_name=sqs_region) # trying this in AP-EAST-1 (sqs region)
         self.sqsclient = boto3.client('sqs', region_name=sqs_region)
         self.sqs_passdata_url = None
         self.sqs_preview_url = None
+        # all uploads and SQS messages are scheduled by priority class through the shaper
+        self.shaper = uploadShaper or shaper.UploadShaper()
 
 # remove files (but not directories) from a given directory
 def removeFiles(directory):
@@ -139,6 +142,9 @@ def recordChunksFM(satellite, minChunkDuration, maxChunkDuration, aws):
     # the radio device between recordings (2 second sleep), but that should be ok
     timeLeft = duration
     outfiles = []
+
+    # one enhancement engine per pass, so chunks without telemetry wedges reuse the calibration of earlier chunks
+    engine = enhance.EnhancementEngine(config.getlist('ENHANCE', 'variants'))
     for filecount in range(num_chunks):
         outfileName = 'signalchunk_{}'.format(filecount)
         dataDir = config.get('OUTPUTS', 'dataDir')
@@ -149,7 +155,8 @@ def recordChunksFM(satellite, minChunkDuration, maxChunkDuration, aws):
         passInfo = {
                 'satellite' : satellite,
                 'minChunkDuration' : minChunkDuration,
-                'maxChunkDuration' : maxChunkDuration
+                'maxChunkDuration' : maxChunkDuration,
+                'engine' : engine
             }
         if(filecount == 1): 
             inform = True
@@ -184,6 +191,39 @@ def recordChunksFM(satellite, minChunkDuration, maxChunkDuration, aws):
             logging.warning('OS Error: ' + e.strerror)
 
 
+# output paths for each enhancement variant: the first variant takes imagePath, others append their name
+def enhancementPaths(engine, imagePath):
+    root, ext = os.path.splitext(imagePath)
+    paths = {engine.variants[0]: imagePath}
+    for variant in engine.variants[1:]:
+        paths[variant] = '{}_{}{}'.format(root, variant, ext)
+    return paths
+
+# decode APT from a wav with noaa-apt, then calibrate and enhance the frame for every configured variant
+# returns variant -> path of the images ready to upload: every enhancement, only the unenhanced frame (under the
+# first variant) if enhancement failed, or nothing if the decode failed. order is the chunk's position in the pass,
+# None for the archive
+def decodeEnhance(engine, wavPath, rawImagePath, imagePaths, satid, tag, order=None):
+    # a frame left over from an earlier pass must not pass for this decode
+    if os.path.exists(rawImagePath):
+        os.unlink(rawImagePath)
+
+    tlePath = os.path.join(config.get('TLE', 'tleDir'), config.get('TLE', 'tleFile'))
+    aptdec = ['noaa-apt', wavPath, '-o', os.path.relpath(rawImagePath), '-T', tlePath, '-s', satid, '-c', 'disable']
+    proc = subprocess.Popen(aptdec)
+    proc.wait()
+    if proc.returncode != 0 or not os.path.isfile(rawImagePath):
+        logging.warning('APT decode failed with exit code {}, no image to upload [{}]'.format(proc.returncode, tag))
+        return {}
+
+    logging.info('Starting image enhancement [{}]'.format(tag))
+    try:
+        engine.write(rawImagePath, imagePaths, order)
+    except Exception as e:
+        logging.warning('Image enhancement failed ({}), uploading the unenhanced frame [{}]'.format(e, tag))
+        return {engine.variants[0]: rawImagePath}
+    return imagePaths
+
 # transcode raw recording file, process APT decode, upload to S3, remove files
 # intended to be spun off as a thread while recording continues
 def transcodeDecodeUpload(filename, filecount, passInfo, aws, inform=False, allChunks=[]):
@@ -192,6 +232,11 @@ def transcodeDecodeUpload(filename, filecount, passInfo, aws, inform=False, allC
     out_wav = os.path.join(dataDir, os.path.join(config.get('OUTPUTS', 'wav'), '{}.wav'.format(filename)))
     out_mp3 = os.path.join(dataDir, os.path.join(config.get('OUTPUTS', 'mp3'), '{}.mp3'.format(filename)))
     out_img = os.path.join(dataDir, os.path.join(config.get('OUTPUTS', 'img'), '{}.png'.format(filename)))
+    out_img_raw = os.path.join(dataDir, os.path.join(config.get('OUTPUTS', 'img'), '{}_raw.png'.format(filename)))
+
+    # the first configured enhancement is written to out_img, the others alongside it with the variant name appended
+    engine = passInfo['engine']
+    out_imgs = enhancementPaths(engine, out_img)
 
     # sox transformer: raw to wav
     sox_raw2wav = sox.Transformer()
@@ -215,24 +260,33 @@ def transcodeDecodeUpload(filename, filecount, passInfo, aws, inform=False, allC
     logging.info('Starting APT decode [chunk {}]'.format(filecount))
     # aptdec = ['aptdec', out_wav, '-o', os.path.relpath(out_img)]
     satid = passInfo['satellite'].identifier.lower().replace(' ', '_')
-    tlePath = os.path.join(config.get('TLE', 'tleDir'), config.get('TLE', 'tleFile'))
-    aptdec = ['noaa-apt', out_wav, '-o', os.path.relpath(out_img), '-T', tlePath, '-s', satid, '-c', 'histogram']
-    
-    proc = subprocess.Popen(aptdec)
-    proc.wait()
+    images = decodeEnhance(engine, out_wav, out_img_raw, out_imgs, satid, 'chunk {}'.format(filecount), filecount)
 
     # upload files to S3
     if(upload):
         bucket_name = config.get('AWS', 's3_bucket')
+        bucket = aws.s3.Bucket(bucket_name)
         logging.info('Starting S3 upload sequence [chunk {}]'.format(filecount))
-        img = open(out_img, 'rb')
-        aws.s3.Bucket(bucket_name).put_object(Key='image/{}.png'.format(filename), Body=img)
-        logging.info('Image upload completed [chunk {}]'.format(filecount))
-        img.close()
-        mp3 = open(out_mp3, 'rb')
-        aws.s3.Bucket(bucket_name).put_object(Key='audio/{}.mp3'.format(filename), Body=mp3)
-        logging.info('Audio upload completed [chunk {}]'.format(filecount))
-        mp3.close()
+        # a failed decode still lets the audio and the pass manifest go out
+        img = None
+        if engine.variants[0] in images:
+            img = aws.shaper.upload('live', bucket, 'image/{}.png'.format(filename), images[engine.variants[0]])
+        else:
+            logging.warning('No image to upload [chunk {}]'.format(filecount))
+        mp3 = aws.shaper.upload('live', bucket, 'audio/{}.mp3'.format(filename), out_mp3)
+        for transfer, media in ((img, 'Image'), (mp3, 'Audio')):
+            if not transfer:
+                continue
+            try:
+                transfer.wait()
+                logging.info('{} upload completed in {}s [chunk {}]'.format(media, round(transfer.latency, 1), filecount))
+            except Exception as e:
+                logging.warning('{} upload failed after {}s: {} [chunk {}]'.format(media, round(transfer.latency, 1), e, filecount))
+
+        # extra enhancements are not part of the live performance, so they go out behind it with the archive class
+        for variant in engine.variants[1:]:
+            if variant in images:
+                aws.shaper.upload('archive', bucket, 'image/{}/{}.png'.format(variant, filename), images[variant])
     else:
         logging.info('Uploading skipped [chunk {}]'.format(filecount))
 
@@ -244,6 +298,8 @@ def transcodeDecodeUpload(filename, filecount, passInfo, aws, inform=False, allC
     # archives are uploaded to a separate s3 bucket for safekeeping
     if(allChunks):
         logging.info('Beginning pass archiving routine')
+        # no more live chunks this pass, so archive uploads need not leave room for one
+        aws.shaper.liveFinished()
         archive_path = os.path.join(dataDir, config.get('OUTPUTS','archive'))
 
         # first, remove the last pass archive files
@@ -256,6 +312,8 @@ def transcodeDecodeUpload(filename, filecount, passInfo, aws, inform=False, allC
         archive_filepath_wav = os.path.join(archive_path, '{}.wav'.format(archive_filename))
         archive_filepath_mp3 = os.path.join(archive_path, '{}.mp3'.format(archive_filename))
         archive_filepath_image = os.path.join(archive_path, '{}.png'.format(archive_filename))
+        archive_filepath_image_raw = os.path.join(archive_path, '{}_raw.png'.format(archive_filename))
+        archive_filepath_images = enhancementPaths(engine, archive_filepath_image)
 
         # convert list of recorded chunks into paths to wav files
         allChunksPath = list(map(lambda fn: os.path.join(dataDir, os.path.join(config.get('OUTPUTS', 'wav'), '{}.wav'.format(fn))), allChunks))
@@ -282,22 +340,28 @@ def transcodeDecodeUpload(filename, filecount, passInfo, aws, inform=False, allC
 
         satid = passInfo['satellite'].identifier.lower().replace(' ', '_')
         logging.info('Starting APT decode for archive [{}]'.format(archive_filename))
-        aptdec = ['noaa-apt', archive_filepath_wav, '-o', os.path.relpath(archive_filepath_image), '-T', tlePath, '-s', satid, '-c', 'histogram']
-        proc = subprocess.Popen(aptdec)
-        proc.wait()
+        archive_images = decodeEnhance(engine, archive_filepath_wav, archive_filepath_image_raw, archive_filepath_images, satid, archive_filename)
         
         if(upload):
             logging.info('Starting S3 upload sequence for archive [{}]'.format(archive_filename))
             archive_bucket_name = config.get('AWS', 's3_bucket_archive')              
-            img = open(archive_filepath_image, 'rb')
-            aws.s3_archive.Bucket(archive_bucket_name).put_object(Key='images/{}.png'.format(archive_filename), Body=img)
-            logging.info('Image upload completed [{}]'.format(archive_filename))
-            img.close()
-
-            mp3 = open(archive_filepath_mp3, 'rb')
-            aws.s3_archive.Bucket(archive_bucket_name).put_object(Key='audio/{}.mp3'.format(archive_filename), Body=mp3)
-            logging.info('Audio upload completed [{}]'.format(archive_filename))
-            mp3.close()
+            archive_bucket = aws.s3_archive.Bucket(archive_bucket_name)
+
+            # archive uploads yield to any live chunk or manifest still in flight
+            transfers = [aws.shaper.upload('archive', archive_bucket, 'audio/{}.mp3'.format(archive_filename), archive_filepath_mp3)]
+            for variant, path in archive_images.items():
+                if variant == engine.variants[0]:
+                    key = 'images/{}.png'.format(archive_filename)
+                else:
+                    key = 'images/{}/{}.png'.format(variant, archive_filename)
+                transfers.append(aws.shaper.upload('archive', archive_bucket, key, path))
+            for transfer in transfers:
+                try:
+                    transfer.wait()
+                    logging.info('Archive upload completed in {}s: {} [{}]'.format(round(transfer.latency, 1), transfer.name, archive_filename))
+                except Exception as e:
+                    logging.warning('Archive upload failed: {}: {} [{}]'.format(transfer.name, e, archive_filename))
+            logging.info('Upload shaper stats: {}'.format(aws.shaper.stats()))
         else:
             logging.info('Skipping S3 upload for archive [{}]'.format(archive_filename))
         logging.info('Completed pass archiving routine')
@@ -344,32 +408,37 @@ def informSQSPass(aws, satellite, minChunkDuration, maxChunkDuration):
     }
 
     if(upload):
-        response = aws.sqsclient.send_message(
+        body = json.dumps(message)
+        response = aws.shaper.send('manifest', 'pass info {}'.format(performanceId), len(body), lambda: aws.sqsclient.send_message(
             QueueUrl=aws.sqs_passdata_url,
-            MessageBody=json.dumps(message),
+            MessageBody=body,
             MessageGroupId='groundstation-receiver',
             MessageDeduplicationId=performanceId
-        )
+        )).wait()
         logging.info('Sending SQS pass info: {}\n  --> SQS Response: {}'.format(str(message), response))
     else:
         logging.info('Skipped sending SQS pass info: {}'.format(str(message)))
 
-def informSQSPreview(aws, satellite, maxChunkDuration):
+def informSQSPreview(aws, satellite, maxChunkDuration, startTime=None):
     # send SQS message with upcoming pass data (preview)
     # satellite nextPass should already been assigned its unique performanceID before this is called
+    # startTime (a timestamp) overrides this station's predicted AOS, e.g. with the one agreed between stations
     # website time delay included in start time (2x chunk duration)
+    if startTime is None:
+        startTime = satellite.nextPass.passTime.timestamp()
     message = {
         "nextsatelliteName": satellite.identifier,
-        "nextperformanceStartTime": round(satellite.nextPass.passTime.timestamp()) + 2*(maxChunkDuration+1), 
+        "nextperformanceStartTime": round(startTime) + 2*(maxChunkDuration+1), 
         "nextperformanceId": satellite.nextPass.performanceID,
     }
     if(upload):
-        response = aws.sqsclient.send_message(
+        body = json.dumps(message)
+        response = aws.shaper.send('manifest', 'preview {}'.format(satellite.nextPass.performanceID), len(body), lambda: aws.sqsclient.send_message(
             QueueUrl=aws.sqs_preview_url,
-            MessageBody=json.dumps(message),
+            MessageBody=body,
             MessageGroupId='groundstation-receiver',
             MessageDeduplicationId=satellite.nextPass.performanceID
-        )
+        )).wait()
         logging.info('Sending SQS preview info: {}\n  --> SQS Response: {}'.format(str(message), response))
     else:
         logging.info('Skipped sending SQS preview: {}'.format(str(message)))
@@ -401,10 +470,13 @@ if __name__ == "__main__":
     # global AWS object to be passed around
     s3_region = config.get('AWS','s3_region')
     sqs_region = config.get('AWS','sqs_region')
-    aws = AWS(s3_region=s3_region, sqs_region=sqs_region)
+    aws = AWS(s3_region=s3_region, sqs_region=sqs_region, uploadShaper=shaper.fromConfig(config))
     aws.sqs_passdata_url = config.get('AWS', 'sqs_passdata_url')
     aws.sqs_preview_url = config.get('AWS', 'sqs_preview_url')
 
+    # shares the pass schedule with other receiver stations, None when running standalone
+    coordinator = coordinate.fromConfig(config)
+
     satIDs = config.getlist('SATELLITES', 'identifiers')
     frequencies = config.getlist('SATELLITES', 'frequencies')
     satellites = []
@@ -424,9 +496,19 @@ if __name__ == "__main__":
         satQueue = sorted(satellites, key=lambda p : p.predictNextPass(qth, minElev, cut_start, cut_end).passTime)
         nextSat = satQueue[0]
 
-        # send SQS message with upcoming pass data
-        nextSat.nextPass.performanceID = str(uuid4()) # give the upcoming pass a unique ID
-        informSQSPreview(aws, nextSat, maxChunkDuration)
+        # give the upcoming pass an ID that is the same from every station, so downstream messages deduplicate;
+        # when coordinating, announce may replace it with the ID another station already gave the same pass
+        nextSat.nextPass.performanceID = coordinate.passID(nextSat)
+
+        # send SQS message with upcoming pass data; when coordinating, only the first station to claim the preview
+        # sends it, with the start time of the best placed station
+        if coordinator:
+            coordinator.announce(nextSat)
+            startTime = coordinator.previewStart(nextSat)
+            if startTime is not None:
+                informSQSPreview(aws, nextSat, maxChunkDuration, startTime)
+        else:
+            informSQSPreview(aws, nextSat, maxChunkDuration)
 
         timeUntilPass = nextSat.nextPass.passTime - datetime.now(timezone.utc)
         if(timeUntilPass.total_seconds()>0):
@@ -434,24 +516,28 @@ if __name__ == "__main__":
                 logging.info(' {} at {} UTC, max elev. {} degrees'.format(sat.identifier, str(sat.nextPass.passTime).split('.')[0], round(sat.nextPass.elevation)))
             time.sleep(timeUntilPass.total_seconds())
         
-        # just in case rtl_fm is still running, if python was shut down uncleanly
-        tryKill('rtl_fm')
-
-        logging.info('Beginning capture of {} at {} {}: duration {}, max_elev. {} degrees'.format(
-            nextSat.identifier, 
-            str(datetime.now(timezone.utc)).split('.')[0], 
-            str(timezone.utc),
-            round(nextSat.nextPass.duration), 
-            round(nextSat.nextPass.elevation)
-        ))
-        recordChunksFM(nextSat, minChunkDuration, maxChunkDuration, aws)
-        
-        # just in case rtl_fm is still running, if python was shut down uncleanly
-        tryKill('rtl_fm')
+        # when coordinating, only the station that claims the pass records it
+        if coordinator and not coordinator.takePass(nextSat):
+            logging.info('Skipping capture of {}, recorded by another station'.format(nextSat.identifier))
+        else:
+            # just in case rtl_fm is still running, if python was shut down uncleanly
+            tryKill('rtl_fm')
+
+            logging.info('Beginning capture of {} at {} {}: duration {}, max_elev. {} degrees'.format(
+                nextSat.identifier, 
+                str(datetime.now(timezone.utc)).split('.')[0], 
+                str(timezone.utc),
+                round(nextSat.nextPass.duration), 
+                round(nextSat.nextPass.elevation)
+            ))
+            recordChunksFM(nextSat, minChunkDuration, maxChunkDuration, aws)
+            
+            # just in case rtl_fm is still running, if python was shut down uncleanly
+            tryKill('rtl_fm')
 
         # pull TLEs from file once per day
         if (tleLastUpdated != datetime.now(timezone.utc).day):
-            updateTLE(satellites, tlePath)
+            updateTLE(satellites, tlePath, tleUrl)
             tleLastUpdated = datetime.now(timezone.utc).day
 
         # sleep for a couple minutes
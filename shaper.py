@@ -0,0 +1,351 @@
+import os, time, logging, threading, queue
+
+# shaper.py schedules uploads over the shared uplink by priority class, so that the archive burst at the end of a
+# pass does not hold up the live chunks viewers are waiting for.
+#
+# Each class has its own queue and worker thread. Files are sent as whole objects, or as multipart upload parts of
+# PART_SIZE when larger, and all pacing happens between those requests: never while a request is open, where S3
+# drops sockets left idle for around 20s. Before each request a transfer draws its bytes from a shared uplink token
+# bucket and an optional per-class token bucket. A lower class transfer first pauses while a higher class has work
+# queued or in flight, for at most the live latency target, so a live chunk gets the uplink to itself. While live
+# chunks are arriving, it also waits to start a request until, at the measured throughput, the request would finish
+# early enough for the next expected chunk to still make the live latency target. It then draws its tokens in
+# slices without running the buckets into debt, and hands them back if a higher class turns up before it has them
+# all, so live uploads are never charged for bytes a lower class reserved but did not send.
+#
+# example usage:
+# shaper = UploadShaper(uplinkRate=500000, classRates={'archive': 200000}, liveLatencyTarget=10)
+# transfer = shaper.upload('live', aws.s3.Bucket('bucket'), 'image/signalchunk_0.png', '/path/to/signalchunk_0.png')
+# transfer.wait()
+
+# priority classes, highest first: live chunk media, then manifests (SQS pass messages), then archive
+CLASSES = ['live', 'manifest', 'archive']
+
+# files larger than this go up as a multipart upload in parts of this size (the S3 minimum), so that a long
+# archive upload can be preempted between parts
+PART_SIZE = 5 * 1024 * 1024
+
+# throughput is sampled from requests of at least this many bytes, where transfer time outweighs the round trip,
+# and each new sample is given this weight
+MIN_SAMPLE_BYTES = 64 * 1024
+THROUGHPUT_SMOOTHING = 0.3
+
+# lower classes draw tokens in slices of this many bytes, checking for higher class work between slices
+TOKEN_SLICE = 64 * 1024
+
+# live submissions within LIVE_BURST seconds of each other are one chunk (its image and audio); gaps between chunks
+# longer than LIVE_GAP seconds fall between passes and are not counted towards the expected chunk interval
+LIVE_BURST = 2
+LIVE_GAP = 300
+
+
+# token bucket limiting a byte rate, rate 0 is unlimited
+# tokens may go negative, so a single large request waits for exactly the time it needs at the configured rate
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens = self.tokens - n
+            deficit = -self.tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+    # take n tokens (at most the bucket's capacity) once they are available, without going into debt
+    def take(self, n):
+        if not self.rate:
+            return
+        n = min(n, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= n:
+                    self.tokens = self.tokens - n
+                    return
+                shortfall = n - self.tokens
+            time.sleep(shortfall / self.rate)
+
+    # return tokens taken for bytes that were not sent
+    def refund(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + n)
+
+# smoothed measure of the bytes per second actually getting through the uplink, from the duration of each request
+class ThroughputMeter:
+    def __init__(self):
+        self.rate = None
+        self.lock = threading.Lock()
+
+    def add(self, n, seconds):
+        if n < MIN_SAMPLE_BYTES or seconds <= 0:
+            return
+        sample = n / seconds
+        with self.lock:
+            self.rate = smooth(self.rate, sample)
+
+# exponentially weighted mean of a series, starting from its first value
+def smooth(mean, sample):
+    return sample if mean is None else THROUGHPUT_SMOOTHING*sample + (1 - THROUGHPUT_SMOOTHING)*mean
+
+# a queued transfer: run(request) performs it, making each network request of n bytes through request(n, fn)
+class Transfer:
+    def __init__(self, cls, name, size, run):
+        self.cls = cls
+        self.name = name
+        self.size = size
+        self.run = run
+        self.queued = time.monotonic()
+        self.latency = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    # block until the transfer has completed, raising the transfer's error if it failed
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        if self.error:
+            raise self.error
+        return self.result
+
+# per-class counters
+class ClassStats:
+    def __init__(self):
+        self.transfers = 0
+        self.failures = 0
+        self.bytes = 0
+        self.lastLatency = None
+        self.maxLatency = 0
+        self.totalLatency = 0
+        self.missedTarget = 0
+
+
+class UploadShaper:
+    def __init__(self, uplinkRate=0, classRates=None, liveLatencyTarget=10):
+        classRates = classRates or {}
+        self.uplink = TokenBucket(uplinkRate)
+        self.buckets = {cls: TokenBucket(classRates.get(cls, 0)) for cls in CLASSES}
+        self.liveLatencyTarget = liveLatencyTarget
+        self.meter = ThroughputMeter()
+        self.queues = {cls: queue.Queue() for cls in CLASSES}
+        self.active = {cls: 0 for cls in CLASSES}
+        self.counters = {cls: ClassStats() for cls in CLASSES}
+        # live chunk arrivals: start of the latest chunk, and smoothed interval between chunks and bytes per chunk
+        self.lastLive = None
+        self.liveBytes = 0
+        self.liveInterval = None
+        self.liveSize = None
+        self.lock = threading.Lock()
+        for cls in CLASSES:
+            threading.Thread(target=self.worker, args=(cls,), daemon=True).start()
+
+    # queue a file upload to an S3 bucket, as a single object or in PART_SIZE parts
+    def upload(self, cls, bucket, key, path):
+        client = bucket.meta.client
+        def run(request):
+            with open(path, 'rb') as f:
+                if os.path.getsize(path) <= PART_SIZE:
+                    body = f.read()
+                    return request(len(body), lambda: client.put_object(Bucket=bucket.name, Key=key, Body=body))
+                multipart = client.create_multipart_upload(Bucket=bucket.name, Key=key)
+                parts = []
+                try:
+                    while True:
+                        body = f.read(PART_SIZE)
+                        if not body:
+                            break
+                        number = len(parts) + 1
+                        response = request(len(body), lambda: client.upload_part(
+                            Bucket=bucket.name, Key=key, UploadId=multipart['UploadId'], PartNumber=number, Body=body))
+                        parts.append({'ETag': response['ETag'], 'PartNumber': number})
+                    return client.complete_multipart_upload(
+                        Bucket=bucket.name, Key=key, UploadId=multipart['UploadId'], MultipartUpload={'Parts': parts})
+                except Exception:
+                    client.abort_multipart_upload(Bucket=bucket.name, Key=key, UploadId=multipart['UploadId'])
+                    raise
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        return self.submit(Transfer(cls, key, size, run))
+
+    # queue a small request (e.g. an SQS message) of the given size, returning fn's result on the transfer
+    def send(self, cls, name, size, fn):
+        def run(request):
+            return request(size, fn)
+        return self.submit(Transfer(cls, name, size, run))
+
+    def submit(self, transfer):
+        if transfer.cls not in self.queues:
+            raise ValueError('Unknown upload class {}, expected one of {}'.format(transfer.cls, CLASSES))
+        if transfer.cls == 'live':
+            self.liveArrived(transfer.size)
+            if self.meter.rate:
+                estimate = transfer.size / self.meter.rate
+                if estimate > self.liveLatencyTarget:
+                    logging.warning('Live upload {} needs ~{}s at {} B/s, over the {}s latency target'.format(
+                        transfer.name, round(estimate), round(self.meter.rate), self.liveLatencyTarget))
+        self.queues[transfer.cls].put(transfer)
+        return transfer
+
+    # track when live chunks arrive and how large they are, to predict the next one
+    def liveArrived(self, size):
+        now = time.monotonic()
+        with self.lock:
+            if self.lastLive is not None and now - self.lastLive < LIVE_BURST:
+                self.liveBytes = self.liveBytes + size
+                return
+            if self.lastLive is not None:
+                self.liveSize = smooth(self.liveSize, self.liveBytes)
+                if now - self.lastLive < LIVE_GAP:
+                    self.liveInterval = smooth(self.liveInterval, now - self.lastLive)
+            self.lastLive = now
+            self.liveBytes = size
+
+    # no more live chunks are expected until the next pass, e.g. once its archiving routine starts
+    def liveFinished(self):
+        with self.lock:
+            if self.lastLive is not None:
+                self.liveSize = smooth(self.liveSize, self.liveBytes)
+            self.lastLive = None
+
+    # True while a class above cls has work queued or in flight
+    def preempted(self, cls):
+        with self.lock:
+            return any(self.queues[c].qsize() or self.active[c] for c in CLASSES[:CLASSES.index(cls)])
+
+    # pause a lower class transfer while higher classes are busy, until the deadline
+    # only called between requests, so no S3 request is held open while paused
+    def yieldTo(self, cls, deadline):
+        while self.preempted(cls) and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    # the bytes per second a request can expect: the measured throughput, capped by the uplink rate limit, or None
+    # before anything has been measured or limited
+    def expectedRate(self):
+        rates = [rate for rate in (self.meter.rate, self.uplink.rate) if rate]
+        return min(rates) if rates else None
+
+    # pause a lower class request of n bytes that would still be running when the next live chunk, expected one
+    # chunk interval after the last, could no longer meet the live latency target. The expectation lapses once
+    # the next chunk is a latency target overdue
+    def awaitLiveBudget(self, n):
+        while True:
+            rate = self.expectedRate()
+            with self.lock:
+                lastLive, interval, size = self.lastLive, self.liveInterval, self.liveSize or self.liveBytes
+            if lastLive is None or interval is None or not rate:
+                return
+            now = time.monotonic()
+            nextLive = lastLive + interval
+            if now > nextLive + self.liveLatencyTarget:
+                return
+            if now + n / rate <= nextLive + max(self.liveLatencyTarget - size / rate, 0):
+                return
+            time.sleep(0.1)
+
+    # draw the tokens for n bytes about to be sent in cls. Live draws them at once, paying any debt by waiting.
+    # Lower classes first wait for the live budget and yield to higher classes (for at most the live latency
+    # target in all), then take their tokens slice by slice; if a higher class turns up before they have them all,
+    # the slices taken are refunded and they wait again
+    def acquire(self, cls, n):
+        if cls == CLASSES[0]:
+            self.buckets[cls].consume(n)
+            self.uplink.consume(n)
+            return
+        deadline = None
+        while True:
+            self.awaitLiveBudget(n)
+            if deadline is None:
+                deadline = time.monotonic() + self.liveLatencyTarget
+            self.yieldTo(cls, deadline)
+            taken = 0
+            while taken < n and not (self.preempted(cls) and time.monotonic() < deadline):
+                size = min(TOKEN_SLICE, n - taken)
+                self.buckets[cls].take(size)
+                self.uplink.take(size)
+                taken = taken + size
+            if taken >= n:
+                return
+            self.buckets[cls].refund(taken)
+            self.uplink.refund(taken)
+
+    # request function for a transfer in cls: acquires the n bytes about to be sent before calling fn, which makes
+    # one network request, then meters how long it took
+    def requester(self, cls):
+        def request(n, fn):
+            self.acquire(cls, n)
+            start = time.monotonic()
+            result = fn()
+            self.meter.add(n, time.monotonic() - start)
+            return result
+        return request
+
+    def worker(self, cls):
+        while True:
+            transfer = self.queues[cls].get()
+            with self.lock:
+                self.active[cls] = self.active[cls] + 1
+            try:
+                transfer.result = transfer.run(self.requester(cls))
+            except Exception as e:
+                transfer.error = e
+                logging.warning('Upload failed [{}] {}: {}'.format(cls, transfer.name, e))
+            transfer.latency = time.monotonic() - transfer.queued
+            with self.lock:
+                self.active[cls] = self.active[cls] - 1
+                self.record(cls, transfer)
+            transfer.done.set()
+
+    def record(self, cls, transfer):
+        counters = self.counters[cls]
+        if transfer.error:
+            counters.failures = counters.failures + 1
+            return
+        counters.transfers = counters.transfers + 1
+        counters.bytes = counters.bytes + transfer.size
+        counters.lastLatency = transfer.latency
+        counters.maxLatency = max(counters.maxLatency, transfer.latency)
+        counters.totalLatency = counters.totalLatency + transfer.latency
+        if cls == 'live' and transfer.latency > self.liveLatencyTarget:
+            counters.missedTarget = counters.missedTarget + 1
+            logging.warning('Live upload {} took {}s, over the {}s latency target'.format(
+                transfer.name, round(transfer.latency, 1), self.liveLatencyTarget))
+
+    # snapshot of per-class byte and latency counters, and the measured uplink throughput in bytes per second
+    def stats(self):
+        with self.lock:
+            classes = {}
+            for cls, c in self.counters.items():
+                classes[cls] = {
+                    'transfers': c.transfers,
+                    'failures': c.failures,
+                    'bytes': c.bytes,
+                    'queued': self.queues[cls].qsize(),
+                    'lastLatency': c.lastLatency,
+                    'meanLatency': c.totalLatency / c.transfers if c.transfers else None,
+                    'maxLatency': c.maxLatency,
+                    'missedTarget': c.missedTarget
+                }
+            return {'throughput': self.meter.rate, 'classes': classes}
+
+
+# build an UploadShaper from the SHAPER section of a groundstation config, unlimited if the section is missing
+def fromConfig(config):
+    if not config.has_section('SHAPER'):
+        return UploadShaper()
+    classRates = {cls: int(config.get('SHAPER', '{}Rate'.format(cls))) for cls in CLASSES}
+    return UploadShaper(
+        uplinkRate=int(config.get('SHAPER', 'uplinkRate')),
+        classRates=classRates,
+        liveLatencyTarget=float(config.get('SHAPER', 'liveLatencyTarget')))
@@ -0,0 +1,34 @@
+import os, sys, logging
+import numpy as np
+
+sys.path.append('../')
+import enhance
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+# checkCalibration runs telemetry wedge detection over the pre-recorded image chunks in test_data/img, in pass order,
+# and reports the telemetry phase and calibration used for each chunk. Chunks without usable wedges should pick up
+# the last calibration found earlier in the pass. Exits with an error if no chunk yields a telemetry phase.
+
+if __name__ == "__main__":
+    imgDir = 'test_data/img'
+    filenames = sorted(os.listdir(imgDir), key=lambda fn: int(os.path.splitext(fn)[0].split('_')[-1]))
+
+    engine = enhance.EnhancementEngine(['histogram'])
+    found = 0
+    for order, filename in enumerate(filenames):
+        frame = enhance.loadFrame(os.path.join(imgDir, filename))
+        stripA = frame[:, enhance.TELEMETRY_A[0]+5:enhance.TELEMETRY_A[1]-5].mean(axis=1)
+        stripB = frame[:, enhance.TELEMETRY_B[0]+5:enhance.TELEMETRY_B[1]-5].mean(axis=1)
+        phase = enhance.findTelemetryPhase((stripA + stripB) / 2)
+        lutA, lutB = engine.calibrate(frame, order)
+        calibrated = [not np.array_equal(lut, np.arange(256)) for lut in (lutA, lutB)]
+        logging.info('{}: {} lines, telemetry phase {}, channels calibrated A={} B={}'.format(
+            filename, frame.shape[0], phase, calibrated[0], calibrated[1]))
+        if phase is not None:
+            found = found + 1
+
+    if not found:
+        logging.error('No telemetry phase found in any of {} chunks'.format(len(filenames)))
+        exit(-1)
+    logging.info('Telemetry phase found in {} of {} chunks'.format(found, len(filenames)))